@@ -0,0 +1,395 @@
+# competitor_core.py — Google Sheets data layer for the Competitor INCI Explorer
+# ---------------------------------------------------------------------------
+# Shared by the Streamlit UI (competitor_inci_explorer.py):
+# - Service-account auth, retry/backoff for Sheets/Drive calls
+# - Tab TEMPLATE, cached loading (CSV export + parquet disk cache)
+# - Batched writes, id counters, canonical name keys, FUNCTION_MAP
+# - Cached derived tables (denormalized view, frequency, sidebar indexes)
+# ---------------------------------------------------------------------------
+
+import hashlib
+import io
+import json
+import random
+import shutil
+import time
+import unicodedata
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from pathlib import Path
+from typing import Dict, Any, List
+
+import pandas as pd
+import streamlit as st
+import gspread
+import requests
+from google.auth.transport.requests import AuthorizedSession
+from google.oauth2.service_account import Credentials
+
+SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive",
+]
+
+# ---------------------------------------------------------------------------
+# Quota-friendly: retry helper + caching layers
+# ---------------------------------------------------------------------------
+def get_service_account_info():
+    cfg = st.secrets["gsheets"]
+    sa = cfg.get("service_account")
+
+    if isinstance(sa, str):
+        # JSON string case (when you pasted raw JSON into secrets)
+        return json.loads(sa)
+    elif isinstance(sa, Mapping):
+        # TOML table case (AttrDict) → convert to normal dict
+        return dict(sa)
+    else:
+        raise TypeError(f"Unsupported service_account type: {type(sa)}")
+
+RETRY_STATUSES = {429, 500, 503}
+# values.append is not idempotent: a 5xx may arrive after the rows were written, so appends
+# only retry on 429 (rejected before applying) to avoid duplicate rows
+APPEND_RETRY_STATUSES = {429}
+MAX_ATTEMPTS = 5
+MAX_DELAY = 8
+
+# Server-provided Retry-After (seconds) when present, else 0.5s, 1s, 2s, 4s… ±20% jitter;
+# either way capped at MAX_DELAY so one wait can't stall a rerun
+def retry_delay(e: Exception, attempt: int) -> float:
+    response = getattr(e, "response", None)
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    try:
+        return min(max(0.0, float(retry_after)), MAX_DELAY)
+    except (TypeError, ValueError):
+        return min(MAX_DELAY, 0.5 * 2 ** attempt) * random.uniform(0.8, 1.2)
+
+def with_backoff(fn=None, *, retry_statuses=RETRY_STATUSES):
+    if fn is None:
+        return lambda f: with_backoff(f, retry_statuses=retry_statuses)
+    @wraps(fn)
+    def _inner(*args, **kwargs):
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                return fn(*args, **kwargs)
+            except (gspread.exceptions.APIError, requests.HTTPError) as e:
+                status = getattr(getattr(e, "response", None), "status_code", None)
+                if status not in retry_statuses or attempt == MAX_ATTEMPTS - 1:
+                    raise
+                time.sleep(retry_delay(e, attempt))
+    return _inner
+
+# Service-account credentials, shared by gspread (writes) and the CSV/Drive session (reads)
+@st.cache_resource
+def get_credentials():
+    return Credentials.from_service_account_info(get_service_account_info(), scopes=SCOPES)
+
+@st.cache_resource
+def get_gc_and_sheet():
+    gc = gspread.authorize(get_credentials())
+    sh = gc.open_by_key(st.secrets["gsheets"]["spreadsheet_id"])
+    return gc, sh
+
+TEMPLATE = {
+    "Brands": ["id", "name", "brand_key"],
+    "Products": ["id", "brand_id", "product_name", "category", "product_type", "notes"],
+    "Ingredients": ["id", "inci_name", "default_function", "cas", "inci_name_key"],
+    "Product_Ingredients": ["id", "product_id", "ingredient_id", "inci_name_raw", "function_override", "percentage", "notes"],
+    "Ingredient_Frequency": ["ingredient_id", "category", "product_type", "count"],
+    "Meta": ["key", "value"],
+}
+
+# Meta counters → the tab whose ids they allocate
+COUNTERS = {
+    "next_brand_id": "Brands",
+    "next_product_id": "Products",
+    "next_ingredient_id": "Ingredients",
+    "next_pi_id": "Product_Ingredients",
+}
+
+# Tabs with a persisted canonical lookup key: tab → (source column, key column)
+KEY_COLUMNS = {"Brands": ("name", "brand_key"), "Ingredients": ("inci_name", "inci_name_key")}
+
+# Canonical form for name matching: NFKC, casefolded, whitespace collapsed
+def canon(name: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", name).casefold().split())
+
+# Worksheet handles by title (cached); missing tabs are created in one batchUpdate, and
+# existing tabs whose header row predates newer TEMPLATE columns (e.g. brand_key,
+# inci_name_key) get the full TEMPLATE header written in the same values.batchUpdate
+@st.cache_resource
+def get_worksheets():
+    _, sh = get_gc_and_sheet()
+    existing = {ws.title: ws for ws in with_backoff(sh.worksheets)()}
+    missing = [name for name in TEMPLATE if name not in existing]
+    present = [name for name in TEMPLATE if name in existing]
+    header_names = list(missing)
+    if present:
+        resp = with_backoff(sh.values_batch_get)([f"{name}!1:1" for name in present])
+        for name, vr in zip(present, resp.get("valueRanges", [])):
+            header = (vr.get("values") or [[]])[0]
+            # Only extend headers that are a prefix of TEMPLATE, so existing columns keep their labels
+            if header and len(header) < len(TEMPLATE[name]) and header == TEMPLATE[name][:len(header)]:
+                header_names.append(name)
+    if missing:
+        # addSheet isn't idempotent, so only retry a 429 (rejected before it ran)
+        with_backoff(sh.batch_update, retry_statuses=APPEND_RETRY_STATUSES)({"requests": [
+            {"addSheet": {"properties": {"title": name, "gridProperties": {"rowCount": 2000, "columnCount": 20}}}}
+            for name in missing
+        ]})
+    if header_names:
+        with_backoff(sh.values_batch_update)({
+            "valueInputOption": "RAW",
+            "data": [{"range": f"{name}!A1", "values": [TEMPLATE[name]]} for name in header_names],
+        })
+    if missing:
+        existing = {ws.title: ws for ws in with_backoff(sh.worksheets)()}
+    return existing
+
+NUMERIC_COLUMNS = ["id","brand_id","product_id","ingredient_id","percentage","count"]
+
+# Authorized HTTP session for the CSV export endpoint (reads only; writes stay on gspread)
+@st.cache_resource
+def get_session():
+    return AuthorizedSession(get_credentials())
+
+@with_backoff
+def fetch_tab_csv(session, spreadsheet_id: str, gid: int) -> bytes:
+    r = session.get(f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}/export",
+                    params={"format": "csv", "gid": gid}, timeout=30)
+    r.raise_for_status()
+    return r.content
+
+def parse_tab(name: str, content: bytes) -> pd.DataFrame:
+    try:
+        # Known text columns stay str ("" for blanks); only numeric columns read blanks as NaN.
+        # Blank lines are kept so row positions keep matching sheet rows.
+        df = pd.read_csv(
+            io.BytesIO(content),
+            dtype={c: str for c in TEMPLATE[name] if c not in NUMERIC_COLUMNS},
+            keep_default_na=False, na_values={c: [""] for c in NUMERIC_COLUMNS},
+            skip_blank_lines=False,
+        )
+    except pd.errors.EmptyDataError:
+        df = pd.DataFrame(columns=TEMPLATE[name])
+    for col in NUMERIC_COLUMNS:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+    # Nullable ints for ids/counts, categoricals for the scope columns
+    for col in ["id","brand_id","product_id","ingredient_id","count"]:
+        if col in df.columns:
+            # Non-integral values (e.g. a hand-typed 1.5) become <NA> rather than failing the cast
+            df[col] = df[col].where(df[col].isna() | (df[col] % 1 == 0)).astype("Int64")
+    for col in ["category","product_type"]:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+    if name in KEY_COLUMNS:
+        # Rows written before the key column existed get their key derived in memory
+        src, key = KEY_COLUMNS[name]
+        if key not in df.columns:
+            df[key] = ""
+        missing = df[key] == ""
+        if missing.any() and src in df.columns:
+            df.loc[missing, key] = df.loc[missing, src].map(canon)
+    return df
+
+# Disk cache: .cache/<spreadsheet id>/<hash of schema + Drive modifiedTime>/<tab>.parquet.
+# Bump PARSE_VERSION whenever parse_tab's output changes; TEMPLATE is hashed in directly.
+CACHE_DIR = Path(".cache")
+PARSE_VERSION = 1
+
+def cache_key(modified: str) -> str:
+    schema = json.dumps([PARSE_VERSION, TEMPLATE], sort_keys=True)
+    return hashlib.sha1(f"{schema}\n{modified}".encode()).hexdigest()[:16]
+
+@with_backoff
+def sheet_modified_time(session, spreadsheet_id: str) -> str:
+    r = session.get(f"https://www.googleapis.com/drive/v3/files/{spreadsheet_id}",
+                    params={"fields": "modifiedTime"}, timeout=30)
+    r.raise_for_status()
+    return r.json()["modifiedTime"]
+
+def read_parquet_cache(version_dir: Path):
+    try:
+        return {name: pd.read_parquet(version_dir / f"{name}.parquet") for name in TEMPLATE}
+    except (ImportError, OSError, ValueError):
+        # Missing/partial cache or no parquet engine → fall back to the network
+        return None
+
+def write_parquet_cache(version_dir: Path, dfs: Dict[str, pd.DataFrame]):
+    try:
+        # Older versions of this sheet are stale once a newer modifiedTime is seen
+        for old in version_dir.parent.glob("*"):
+            if old != version_dir:
+                shutil.rmtree(old, ignore_errors=True)
+        version_dir.mkdir(parents=True, exist_ok=True)
+        for name, df in dfs.items():
+            df.to_parquet(version_dir / f"{name}.parquet")
+    except (ImportError, OSError, ValueError, TypeError):
+        shutil.rmtree(version_dir, ignore_errors=True)
+
+def clear_disk_cache():
+    _, sh = get_gc_and_sheet()
+    shutil.rmtree(CACHE_DIR / sh.id, ignore_errors=True)
+
+# All tabs → ({tab: DataFrame}, derived tables); parquet cache hit while the sheet's
+# modifiedTime is unchanged, otherwise the CSV exports are fetched concurrently and cached.
+# Derived tables are built here so reruns reuse them without re-hashing the input frames.
+@st.cache_data(ttl=60)
+def load_all_tabs():
+    _, sh = get_gc_and_sheet()
+    wss = get_worksheets()
+    session = get_session()
+    modified = sheet_modified_time(session, sh.id)
+    version_dir = CACHE_DIR / sh.id / cache_key(modified)
+    dfs = read_parquet_cache(version_dir)
+    if dfs is None:
+        with ThreadPoolExecutor(max_workers=len(TEMPLATE)) as pool:
+            contents = pool.map(lambda name: fetch_tab_csv(session, sh.id, wss[name].id), TEMPLATE)
+            dfs = {name: parse_tab(name, content) for name, content in zip(TEMPLATE, contents)}
+        write_parquet_cache(version_dir, dfs)
+    return dfs, derive_tables(dfs)
+
+# Row dicts → sheet values, ordered by the TEMPLATE headers (no per-call header read)
+def to_values(name: str, rows: List[Dict[str, Any]]) -> List[List[str]]:
+    return [["" if pd.isna(r.get(h)) else str(r.get(h)) for h in TEMPLATE[name]] for r in rows]
+
+@with_backoff(retry_statuses=APPEND_RETRY_STATUSES)
+def append_rows(ws, rows: List[Dict[str, Any]]):
+    if rows:
+        ws.append_rows(to_values(ws.title, rows), value_input_option="RAW")
+
+@with_backoff
+def values_batch_update(data: List[Dict[str, Any]]):
+    if data:
+        _, sh = get_gc_and_sheet()
+        sh.values_batch_update({"valueInputOption": "RAW", "data": data})
+
+# {canonical key: id} for O(1) lookups; first row wins on duplicates
+def name_index(df: pd.DataFrame, key_col: str) -> Dict[str, int]:
+    index = {}
+    if key_col in df.columns and "id" in df.columns:
+        for key, _id in zip(df[key_col], df["id"]):
+            if key and pd.notna(_id):
+                index.setdefault(key, int(_id))
+    return index
+
+# Denormalized Product_Ingredients × Products × Ingredients × Brands, built once per data load
+VIEW_COLUMNS = ["id", "product_id", "brand", "product_name", "category", "product_type", "ingredient_id",
+                "inci_name", "inci_name_raw", "default_function", "function_override", "percentage", "notes"]
+
+def build_view(df_brands: pd.DataFrame, df_prods: pd.DataFrame, df_ings: pd.DataFrame, df_pi: pd.DataFrame) -> pd.DataFrame:
+    view = (
+        df_pi.merge(df_prods, left_on="product_id", right_on="id", how="left", suffixes=("","_p"))
+             .merge(df_ings, left_on="ingredient_id", right_on="id", how="left", suffixes=("","_i"))
+             .merge(df_brands.rename(columns={"name": "brand"}), left_on="brand_id", right_on="id", how="left", suffixes=("","_b"))
+    )
+    return view[VIEW_COLUMNS]
+
+# Tables derived from the loaded tabs; also rebuilt directly after a save
+def derive_tables(dfs: Dict[str, pd.DataFrame]) -> Dict[str, Any]:
+    view = build_view(dfs["Brands"], dfs["Products"], dfs["Ingredients"], dfs["Product_Ingredients"])
+    return {
+        "view": view,
+        "rows_by_product": view_positions_by_product(view),
+        "ptypes_by_category": ptype_index(dfs["Products"]),
+    }
+
+# product_id → positional row indices into the view, so a detail panel is one .iloc
+def view_positions_by_product(view: pd.DataFrame) -> Dict[int, Any]:
+    return {int(pid): idx for pid, idx in view.groupby("product_id").indices.items()}
+
+# category → sorted non-empty product types, for the sidebar's Product Type options
+def ptype_index(df_prods: pd.DataFrame) -> Dict[str, List[str]]:
+    if "category" not in df_prods.columns or "product_type" not in df_prods.columns:
+        return {}
+    grouped = df_prods.dropna(subset=["category"]).groupby("category", observed=True)["product_type"].unique()
+    return {cat: sorted(t for t in types if pd.notna(t) and t) for cat, types in grouped.items()}
+
+# brand id → name as an Int64-indexed Series, for vectorized .map()
+@st.cache_data(ttl=60)
+def brand_names(df_brands: pd.DataFrame) -> pd.Series:
+    named = df_brands.dropna(subset=["id", "name"])
+    id_to_brand = named.set_index("id")["name"]
+    return id_to_brand[~id_to_brand.index.duplicated()]
+
+# Next-id counters from the Meta tab. Saves reserve ids in Meta before appending rows, so a
+# stored counter is never behind its tab; only a counter missing from Meta (sheets that
+# predate it) is seeded from its tab's ids.
+def load_counters(dfs: Dict[str, pd.DataFrame]) -> Dict[str, int]:
+    df_meta = dfs["Meta"]
+    stored = dict(zip(df_meta["key"], pd.to_numeric(df_meta["value"], errors='coerce')))
+    counters = {}
+    for key, tab in COUNTERS.items():
+        value = stored.get(key)
+        if value is None or pd.isna(value):
+            ids = dfs[tab]["id"]
+            value = ids.max() + 1 if ids.notna().any() else 1
+        counters[key] = int(value)
+    return counters
+
+def counter_updates(counters: Dict[str, int]) -> List[Dict[str, Any]]:
+    return [{"range": "Meta!A2", "values": [[key, str(counters[key])] for key in COUNTERS]}]
+
+# Meta flag (the row after the counters) set while a save's frequency deltas are unwritten;
+# a load that sees it rebuilds Ingredient_Frequency from the data tabs
+FREQ_STALE_KEY = "frequency_stale"
+
+def frequency_stale(dfs: Dict[str, pd.DataFrame]) -> bool:
+    df_meta = dfs["Meta"]
+    value = pd.to_numeric(df_meta.loc[df_meta["key"] == FREQ_STALE_KEY, "value"], errors='coerce')
+    return bool((value.fillna(0) != 0).any())
+
+def stale_update(stale: bool) -> List[Dict[str, Any]]:
+    return [{"range": f"Meta!A{len(COUNTERS) + 2}", "values": [[FREQ_STALE_KEY, "1" if stale else "0"]]}]
+
+# Ingredient_Frequency: distinct products per (ingredient_id, category, product_type)
+def rebuild_frequency(view: pd.DataFrame) -> pd.DataFrame:
+    scoped = (view.dropna(subset=["ingredient_id"])
+                  .astype({"category": object, "product_type": object})
+                  .fillna({"category": "", "product_type": ""}))
+    freq = scoped.groupby(["ingredient_id","category","product_type"]).agg(count=("product_id","nunique")).reset_index()
+    return freq[TEMPLATE["Ingredient_Frequency"]]
+
+# Bump counts for one new product → (values.batchUpdate ranges for existing rows,
+# new rows to append, updated in-memory table)
+def frequency_updates(df_freq: pd.DataFrame, ing_ids: List[int], category: str, product_type: str):
+    df_freq = df_freq.copy()
+    pos_by_key = {
+        (int(i), c, t): pos
+        for pos, (i, c, t) in enumerate(zip(df_freq["ingredient_id"], df_freq["category"], df_freq["product_type"]))
+        if pd.notna(i)
+    }
+    updates, new_rows = [], []
+    for ing_id in dict.fromkeys(ing_ids):
+        pos = pos_by_key.get((ing_id, category, product_type))
+        if pos is None:
+            new_rows.append({"ingredient_id": ing_id, "category": category, "product_type": product_type, "count": 1})
+            continue
+        count = df_freq.iloc[pos]["count"]
+        count = (0 if pd.isna(count) else int(count)) + 1
+        df_freq.iloc[pos, df_freq.columns.get_loc("count")] = count
+        updates.append({"range": f"Ingredient_Frequency!A{pos + 2}",
+                        "values": to_values("Ingredient_Frequency", [{
+                            "ingredient_id": ing_id, "category": category, "product_type": product_type, "count": count,
+                        }])})
+    if new_rows:
+        df_freq = pd.concat([df_freq, pd.DataFrame(new_rows)], ignore_index=True)
+    return updates, new_rows, df_freq
+
+# Starter function mapping (expand as you go)
+_FUNCTION_MAP_RAW = {
+    "aqua": "Solvent",
+    "water": "Solvent",
+    "glycerin": "Humectant",
+    "butylene glycol": "Humectant",
+    "dimethicone": "Emollient",
+    "cyclopentasiloxane": "Emollient",
+    "titanium dioxide": "UV Filter",
+    "ethylhexyl methoxycinnamate": "UV Filter",
+    "phenoxyethanol": "Preservative",
+    "ethylhexylglycerin": "Preservative booster",
+}
+# Keyed by canon() so the same key serves Ingredients lookups and default functions
+FUNCTION_MAP = {canon(k): v for k, v in _FUNCTION_MAP_RAW.items()}
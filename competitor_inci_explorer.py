@@ -6,13 +6,17 @@
 # - Explore products by Category / Product Type; view detailed INCI + functions
 # - Ingredient frequency across selected scope
 # - Caching to avoid Google Sheets 429 (quota) with manual Refresh button
+#   (in-memory, plus a parquet copy under .cache/ keyed on the sheet's modifiedTime)
 # - Diagnostics expander to verify connection/tabs
+# Sheets access, caching and derived tables live in competitor_core.py.
 #
 # Requirements (requirements.txt)
 #   streamlit
 #   pandas
 #   gspread
 #   google-auth
+#   requests
+#   pyarrow   (optional: enables the on-disk parquet cache)
 #
 # Secrets (local: .streamlit/secrets.toml; Cloud: App → Settings → Secrets)
 # [gsheets]
@@ -34,114 +38,21 @@
 # client_x509_cert_url = "https://www.googleapis.com/robot/v1/metadata/x509/..."
 # ---------------------------------------------------------------------------
 
-import json
-import time
-from functools import wraps
-from typing import Dict, Any
+import re
 
 import pandas as pd
 import streamlit as st
-import gspread
-from google.oauth2.service_account import Credentials
+
+from competitor_core import (
+    FUNCTION_MAP,
+    TEMPLATE, append_rows, brand_names, canon, clear_disk_cache, counter_updates, derive_tables,
+    frequency_stale, frequency_updates, get_gc_and_sheet, get_worksheets, load_all_tabs, load_counters,
+    name_index, rebuild_frequency, stale_update, to_values, values_batch_update,
+)
 
 st.set_page_config(page_title="Competitor INCI Explorer", layout="wide")
 st.title("🔎 Competitor INCI Explorer")
 
-# ---------------------------------------------------------------------------
-# Quota-friendly: retry helper + caching layers
-# ---------------------------------------------------------------------------
-from collections.abc import Mapping  # add this at top with other imports
-import json
-
-def get_service_account_info():
-    cfg = st.secrets["gsheets"]
-    sa = cfg.get("service_account")
-
-    if isinstance(sa, str):
-        # JSON string case (when you pasted raw JSON into secrets)
-        return json.loads(sa)
-    elif isinstance(sa, Mapping):
-        # TOML table case (AttrDict) → convert to normal dict
-        return dict(sa)
-    else:
-        raise TypeError(f"Unsupported service_account type: {type(sa)}")
-        
-sa_info = get_service_account_info()
-creds = Credentials.from_service_account_info(sa_info, scopes=[
-    "https://www.googleapis.com/auth/spreadsheets",
-    "https://www.googleapis.com/auth/drive",
-])
-gc = gspread.authorize(creds)
-
-def with_backoff(fn):
-    @wraps(fn)
-    def _inner(*args, **kwargs):
-        try:
-            return fn(*args, **kwargs)
-        except gspread.exceptions.APIError as e:
-            if "429" in str(e):
-                time.sleep(1.5)
-                return fn(*args, **kwargs)
-            raise
-    return _inner
-
-@st.cache_resource
-def get_gc_and_sheet():
-    cfg = st.secrets["gsheets"]
-    sa = cfg["service_account"] if isinstance(cfg["service_account"], dict) else json.loads(cfg["service_account"])
-    creds = Credentials.from_service_account_info(sa, scopes=[
-        "https://www.googleapis.com/auth/spreadsheets",
-        "https://www.googleapis.com/auth/drive",
-    ])
-    gc = gspread.authorize(creds)
-    sh = gc.open_by_key(cfg["spreadsheet_id"])
-    return gc, sh
-
-TEMPLATE = {
-    "Brands": ["id", "name"],
-    "Products": ["id", "brand_id", "product_name", "category", "product_type", "notes"],
-    "Ingredients": ["id", "inci_name", "default_function", "cas"],
-    "Product_Ingredients": ["id", "product_id", "ingredient_id", "inci_name_raw", "function_override", "percentage", "notes"],
-}
-
-@st.cache_data(ttl=60)
-@with_backoff
-def load_tab(name: str):
-    _, sh = get_gc_and_sheet()
-    tabs = [ws.title for ws in sh.worksheets()]
-    if name not in tabs:
-        ws = sh.add_worksheet(title=name, rows=2000, cols=20)
-        ws.append_row(TEMPLATE[name])
-    else:
-        ws = sh.worksheet(name)
-    vals = ws.get_all_values()
-    headers = vals[0] if vals else TEMPLATE[name]
-    rows = vals[1:] if len(vals) > 1 else []
-    df = pd.DataFrame(rows, columns=headers)
-    for col in ["id","brand_id","product_id","ingredient_id","percentage"]:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors='coerce')
-    return ws, df
-
-@with_backoff
-def append_row(ws, row: Dict[str, Any]):
-    headers = ws.row_values(1)
-    ws.append_row([str(row.get(h, "")) for h in headers])
-
-# Starter function mapping (expand as you go)
-FUNCTION_MAP = {
-    "aqua": "Solvent",
-    "water": "Solvent",
-    "glycerin": "Humectant",
-    "butylene glycol": "Humectant",
-    "dimethicone": "Emollient",
-    "cyclopentasiloxane": "Emollient",
-    "titanium dioxide": "UV Filter",
-    "ethylhexyl methoxycinnamate": "UV Filter",
-    "phenoxyethanol": "Preservative",
-    "ethylhexylglycerin": "Preservative booster",
-}
-
 # ---------------------------------------------------------------------------
 # Diagnostics (on-demand)
 # ---------------------------------------------------------------------------
@@ -158,6 +69,7 @@ with st.expander("🧪 Diagnostics"):
 with st.sidebar:
     if st.button("🔄 Refresh data"):
         st.cache_data.clear()
+        clear_disk_cache()
         if hasattr(st, "rerun"):
             st.rerun()
         else:
@@ -166,14 +78,38 @@ with st.sidebar:
 
 # Load tabs (cached)
 try:
-    ws_brands, df_brands = load_tab("Brands")
-    ws_prods, df_prods = load_tab("Products")
-    ws_ings,  df_ings  = load_tab("Ingredients")
-    ws_pi,    df_pi    = load_tab("Product_Ingredients")
+    wss = get_worksheets()
+    dfs, derived = load_all_tabs()
+    ws_brands, df_brands = wss["Brands"], dfs["Brands"]
+    ws_prods,  df_prods  = wss["Products"], dfs["Products"]
+    ws_ings,   df_ings   = wss["Ingredients"], dfs["Ingredients"]
+    ws_pi,     df_pi     = wss["Product_Ingredients"], dfs["Product_Ingredients"]
+    ws_freq,   df_freq   = wss["Ingredient_Frequency"], dfs["Ingredient_Frequency"]
+    counters = load_counters(dfs)
 except Exception as e:
     st.error(f"❌ Could not connect/load: {e}")
     st.stop()
 
+# Rebuild Ingredient_Frequency for sheets that predate it, or when a save left it stale.
+# Best-effort: on a failed write the rebuilt table is still shown, saves skip their frequency
+# deltas, and the next load retries the rebuild (which then includes those saves).
+freq_pending = False
+stale = frequency_stale(dfs)
+if stale or (df_freq.empty and not df_pi.empty):
+    rebuilt = rebuild_frequency(derived["view"])
+    # Blank out leftover rows when the rebuilt table is shorter than the stale one
+    values = to_values("Ingredient_Frequency", rebuilt.to_dict("records"))
+    values += [[""] * len(TEMPLATE["Ingredient_Frequency"])] * (len(df_freq) - len(rebuilt))
+    df_freq = rebuilt
+    try:
+        values_batch_update(([{"range": "Ingredient_Frequency!A2", "values": values}] if values else [])
+                            + (stale_update(False) if stale else []))
+        load_all_tabs.clear()
+        clear_disk_cache()
+    except Exception as e:
+        freq_pending = True
+        st.warning(f"Could not rebuild Ingredient_Frequency: {e}")
+
 # ---------------------------------------------------------------------------
 # Sidebar Filters
 # ---------------------------------------------------------------------------
@@ -184,7 +120,7 @@ with st.sidebar:
     sel_cat_q = None if sel_cat == "(All)" else sel_cat
 
     if sel_cat_q:
-        ptypes = ["(All)"] + sorted(df_prods[df_prods["category"]==sel_cat_q]["product_type"].dropna().unique().tolist())
+        ptypes = ["(All)"] + derived["ptypes_by_category"].get(sel_cat_q, [])
     else:
         ptypes = ["(All)"] + sorted(df_prods.get("product_type", pd.Series(dtype=str)).dropna().unique().tolist())
     sel_ptype = st.selectbox("Product Type", ptypes)
@@ -208,69 +144,106 @@ with st.form("add_competitor"):
     submitted = st.form_submit_button("Save to Google Sheets")
 
 if submitted:
+    written, rows_saved = [], False
     try:
-        # Ensure brand
-        ...
+        brand_norm = brand_name.strip()
+        if not brand_norm or not prod_name.strip():
+            raise ValueError("Brand and Product Name are required.")
+
+        # Ensure brand + insert product (appended server-side, like the ingredient rows, so rows
+        # added since the cached snapshot are never overwritten)
+        new_brand_rows = []
+        brand_key = canon(brand_norm)
+        brand_id = name_index(df_brands, "brand_key").get(brand_key)
+        if brand_id is None:
+            brand_id = counters["next_brand_id"]
+            counters["next_brand_id"] += 1
+            new_brand_rows.append({"id": brand_id, "name": brand_norm, "brand_key": brand_key})
+
+        next_pid = counters["next_product_id"]
+        counters["next_product_id"] += 1
+        new_prod_rows = [{
+            "id": next_pid, "brand_id": brand_id, "product_name": prod_name.strip(),
+            "category": prod_cat.strip(), "product_type": prod_type.strip(), "notes": prod_notes.strip(),
+        }]
+
         # Split INCI list
-        tokens = []
-        for line in inci_raw.replace("\r", "\n").split("\n"):
-            for part in line.split(","):
-                name = part.strip()
-                if name:
-                    tokens.append(name)
+        tokens = [t.strip() for t in re.split(r"[,\n\r]+", inci_raw) if t.strip()]
 
-        # process tokens...
+        # Prepare next IDs
+        next_ing_id = counters["next_ingredient_id"]
+        next_pi_id  = counters["next_pi_id"]
+
+        # Resolve all tokens against Ingredients in one merge (left merge keeps paste order);
+        # unmatched keys get new ids in first-seen order. New rows are flushed with one
+        # append_rows per sheet.
+        # dtype=object so an empty paste still merges against the str key column
+        tok = pd.DataFrame({"key": [canon(t) for t in tokens], "raw": tokens}, dtype=object)
+        known = (df_ings.dropna(subset=["id"])
+                        .drop_duplicates("inci_name_key")[["inci_name_key", "id"]]
+                        .rename(columns={"inci_name_key": "key", "id": "ing_id"}))
+        m = tok.merge(known, on="key", how="left")
+
+        unmatched = m[m["ing_id"].isna()].drop_duplicates("key")
+        new_ings = pd.DataFrame({
+            "id": pd.array(range(next_ing_id, next_ing_id + len(unmatched)), dtype="Int64"),
+            "inci_name": unmatched["raw"].to_numpy(),
+            "default_function": unmatched["key"].map(FUNCTION_MAP).fillna("").to_numpy(),
+            "cas": "",
+            "inci_name_key": unmatched["key"].to_numpy(),
+        })
+        m["ing_id"] = m["ing_id"].fillna(m["key"].map(dict(zip(new_ings["inci_name_key"], new_ings["id"])))).astype("Int64")
+        new_pi = pd.DataFrame({
+            "id": pd.array(range(next_pi_id, next_pi_id + len(m)), dtype="Int64"),
+            "product_id": next_pid,
+            "ingredient_id": m["ing_id"],
+            "inci_name_raw": m["raw"],
+            "function_override": "",
+            "percentage": None,
+            "notes": "",
+        })
+        counters["next_ingredient_id"] = next_ing_id + len(new_ings)
+        counters["next_pi_id"] = next_pi_id + len(new_pi)
+        new_ing_rows, new_pi_rows = new_ings.to_dict("records"), new_pi.to_dict("records")
+
+        # Grow the in-memory tables once instead of per token
+        if new_ing_rows:
+            df_ings = pd.concat([df_ings, new_ings], ignore_index=True)
+        if new_pi_rows:
+            df_pi = pd.concat([df_pi, new_pi], ignore_index=True)
+
+        # Reserve the ids in Meta before appending, so a failed append can only skip ids,
+        # never hand them out twice; the stale flag stays set until the counts are written
+        values_batch_update(counter_updates(counters) + stale_update(True))
+        for ws, rows in ((ws_brands, new_brand_rows), (ws_prods, new_prod_rows),
+                         (ws_ings, new_ing_rows), (ws_pi, new_pi_rows)):
+            append_rows(ws, rows)
+            if rows:
+                written.append(ws.title)
+        rows_saved = True
+
+        # Counts last, so a failed append can't leave counts for rows that don't exist
+        if not freq_pending:
+            freq_updates, new_freq_rows, df_freq = frequency_updates(
+                df_freq, [r["ingredient_id"] for r in new_pi_rows], prod_cat.strip(), prod_type.strip())
+            append_rows(ws_freq, new_freq_rows)
+            values_batch_update(freq_updates + stale_update(False))
 
-        st.cache_data.clear()
         st.success(f"Saved product '{prod_name}' with {len(tokens)} ingredients.")
-
     except Exception as e:
-        st.error(f"Failed to save: {e}")
-
-
-
-        # Prepare next IDs
-        next_ing_id = 1 if df_ings.empty else int(pd.to_numeric(df_ings["id"], errors='coerce').max()) + 1
-        next_pi_id  = 1 if df_pi.empty   else int(pd.to_numeric(df_pi["id"],   errors='coerce').max()) + 1
-
-        for inci in tokens:
-            inci_norm = inci.strip()
-            row_match = df_ings[df_ings.get("inci_name", pd.Series(dtype=str)).str.lower()==inci_norm.lower()] if not df_ings.empty else pd.DataFrame()
-            if row_match.empty:
-                func = FUNCTION_MAP.get(inci_norm.lower(), "")
-                append_row(ws_ings, {"id": next_ing_id, "inci_name": inci_norm, "default_function": func, "cas": ""})
-                df_ings.loc[len(df_ings)] = {"id": next_ing_id, "inci_name": inci_norm, "default_function": func, "cas": ""}
-                ing_id = next_ing_id
-                next_ing_id += 1
-            else:
-                ing_id = int(row_match.iloc[0]["id"]) if pd.notna(row_match.iloc[0]["id"]) else None
-                if ing_id is None:
-                    func = FUNCTION_MAP.get(inci_norm.lower(), "")
-                    append_row(ws_ings, {"id": next_ing_id, "inci_name": inci_norm, "default_function": func, "cas": ""})
-                    df_ings.loc[len(df_ings)] = {"id": next_ing_id, "inci_name": inci_norm, "default_function": func, "cas": ""}
-                    ing_id = next_ing_id
-                    next_ing_id += 1
-
-            append_row(ws_pi, {
-                "id": next_pi_id,
-                "product_id": next_pid,
-                "ingredient_id": ing_id,
-                "inci_name_raw": inci_norm,
-                "function_override": "",
-                "percentage": "",
-                "notes": ""
-            })
-            df_pi.loc[len(df_pi)] = {
-                "id": next_pi_id, "product_id": next_pid, "ingredient_id": ing_id,
-                "inci_name_raw": inci_norm, "function_override": "", "percentage": "", "notes": ""
-            }
-            next_pi_id += 1
-
-        # Clear cached data so UI reflects updates
+        if not written:
+            st.error(f"Failed to save: {e}")
+        elif rows_saved:
+            st.warning(f"Saved product '{prod_name}', but Ingredient_Frequency could not be updated ({e}); "
+                       "it will be rebuilt on the next load.")
+        else:
+            st.error(f"Partially saved (wrote {', '.join(written)}): {e}")
+    if written:
+        # Clear cached data so UI reflects updates (Drive's modifiedTime can lag the write)
         st.cache_data.clear()
-        st.success(f"Saved product '{prod_name}' with {len(tokens)} ingredients.")
-    except Exception as e:
-        st.error(f"Failed to save: {e}")
+        clear_disk_cache()
+    if rows_saved:
+        derived = derive_tables({**dfs, "Ingredients": df_ings, "Product_Ingredients": df_pi})
 
 # ---------------------------------------------------------------------------
 # Explore view
@@ -278,23 +251,25 @@ if submitted:
 st.markdown("---")
 st.header("📊 Explore Competitor Products")
 
+view = derived["view"]
+
 _dfv = df_prods.copy()
 if sel_cat_q: _dfv = _dfv[_dfv["category"]==sel_cat_q]
 if sel_ptype_q: _dfv = _dfv[_dfv["product_type"]==sel_ptype_q]
 
 # Map brand_id → brand name
-id_to_brand = {int(r["id"]): r["name"] for _, r in df_brands.iterrows() if pd.notna(r.get("id")) and pd.notna(r.get("name"))}
-_dfv["brand"] = _dfv.get("brand_id", pd.Series(dtype=float)).map(lambda v: id_to_brand.get(int(v), "") if pd.notna(v) else "")
+id_to_brand = brand_names(df_brands)
+_dfv["brand"] = _dfv.get("brand_id", pd.Series(dtype="Int64")).map(id_to_brand).fillna("")
 
 st.dataframe(_dfv[["id","brand","product_name","category","product_type","notes"]].reset_index(drop=True), use_container_width=True, hide_index=True)
 
-sel_ids = st.multiselect("Select product IDs to view details", _dfv.get("id", pd.Series(dtype=float)).dropna().astype(int).tolist())
+sel_ids = st.multiselect("Select product IDs to view details", _dfv.get("id", pd.Series(dtype="Int64")).dropna().astype(int).tolist())
 if sel_ids:
+    rows_by_product = derived["rows_by_product"]
     for pid in sel_ids:
         st.subheader(f"Ingredients — Product ID {pid}")
-        df_one = df_pi[df_pi["product_id"].astype(float)==float(pid)]
-        merged = df_one.merge(df_ings, left_on="ingredient_id", right_on="id", how="left", suffixes=("","_ing"))
-        show = merged[["inci_name_raw","default_function","function_override","percentage","notes"]]
+        df_one = view.iloc[rows_by_product.get(pid, [])]
+        show = df_one[["inci_name_raw","default_function","function_override","percentage","notes"]]
         show.columns = ["INCI","Default Function","Override Function","%","Notes"]
         st.dataframe(show.reset_index(drop=True), use_container_width=True, hide_index=True)
 
@@ -304,11 +279,11 @@ if sel_ids:
 st.markdown("---")
 st.subheader("Ingredient Frequency in Current Scope")
 
-fi = df_pi.merge(df_prods, left_on="product_id", right_on="id", how="left", suffixes=("","_prod"))
+fi = df_freq
 if sel_cat_q: fi = fi[fi["category"]==sel_cat_q]
 if sel_ptype_q: fi = fi[fi["product_type"]==sel_ptype_q]
 
-freq = fi.groupby("ingredient_id").agg(Count=("product_id","nunique")).reset_index()
+freq = fi.groupby("ingredient_id").agg(Count=("count","sum")).reset_index()
 freq = freq.merge(df_ings, left_on="ingredient_id", right_on="id", how="left")
 freq = freq[["inci_name","default_function","Count"]].sort_values(["Count","inci_name"], ascending=[False,True])
 st.dataframe(freq.reset_index(drop=True), use_container_width=True, hide_index=True)